@@ -5,16 +5,13 @@ import os
 import io
 import time
 import random
-from flask import Flask
-from threading import Thread
+import signal
+from aiohttp import web
 import asyncpg
 import asyncio
 import logging
-import matplotlib
-
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-import numpy as np
+import functools
+from datetime import datetime, timezone
 
 # ---------------- Logging ----------------
 logging.basicConfig(
@@ -32,6 +29,14 @@ PORT = int(os.getenv("PORT", "10000"))
 
 MAX_RANKED_USERS = int(os.getenv("MAX_RANKED_USERS", "60"))
 ROLE_EDIT_DELAY = float(os.getenv("ROLE_EDIT_DELAY", "1.0"))
+PENDING_FLUSH_SIZE = int(os.getenv("PENDING_FLUSH_SIZE", "500"))
+PENDING_MAX_SECONDS = int(os.getenv("PENDING_MAX_SECONDS", "300"))
+ROLE_UPDATE_WORKERS = int(os.getenv("ROLE_UPDATE_WORKERS", "4"))
+GUILD_UPDATE_CONCURRENCY = int(os.getenv("GUILD_UPDATE_CONCURRENCY", "2"))
+# How often a still-running stream is credited; bounds the crash-loss window.
+CHECKPOINT_SECONDS = int(os.getenv("CHECKPOINT_SECONDS", "300"))
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
 
 if not TOKEN:
     raise SystemExit("DISCORD_TOKEN missing")
@@ -42,31 +47,31 @@ if not DATABASE_URL:
 intents = discord.Intents.default()
 intents.members = True
 intents.voice_states = True
-intents.message_content = True
-
-bot = commands.Bot(command_prefix="!", intents=intents)
 
-# ---------------- Flask keep-alive ----------------
-app = Flask(__name__)
+# No message_content intent: Discord still delivers the content of messages
+# that mention the bot, which is all the mention-prefixed sync command needs.
+bot = commands.Bot(command_prefix=commands.when_mentioned, intents=intents)
 
-@app.route("/")
-def home():
-    return "Bot alive", 200
+# ---------------- HTTP keep-alive ----------------
+# Served by aiohttp (a discord.py dependency) on the bot's own event loop.
+async def home(request):
+    return web.Response(text="Bot alive")
 
-@app.route("/health")
-def health():
-    return (
+async def health(request):
+    return web.json_response(
         {"status": "healthy", "bot_ready": bot.is_ready()},
-        200 if bot.is_ready() else 503,
+        status=200 if bot.is_ready() else 503,
     )
 
-def run_flask():
-    app.run(host="0.0.0.0", port=PORT, threaded=True)
-
-def keep_alive():
-    t = Thread(target=run_flask, daemon=True)
-    t.start()
-    logger.info(f"Flask server started on port {PORT}")
+async def start_web_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/", home)
+    app.router.add_get("/health", health)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    logger.info("HTTP server started on port %s", PORT)
+    return runner
 
 # ---------------- Role hierarchy (YOUR IDs) ----------------
 ROLE_HIERARCHY = [
@@ -81,48 +86,338 @@ ROLE_HIERARCHY = [
     (1477356266945777828, 2),      # VC MVP
     (1477356310059290767, 1),      # Apex Speaker
 ]
-VC_ROLE_IDS = {rid for rid, _ in ROLE_HIERARCHY}
+VC_ROLE_IDS = frozenset(rid for rid, _ in ROLE_HIERARCHY)
+
+# Shared by every guild update so concurrent runs can't exceed the cap.
+role_edit_sem = asyncio.Semaphore(ROLE_UPDATE_WORKERS)
 
 # ---------------- DB ----------------
 db_pool = None
-join_times = {}  # (guild_id, user_id) -> monotonic start time
+BOOT_MONO = time.monotonic()
+
+def mono_seconds() -> int:
+    """Whole seconds since startup; small ints keep join_times compact."""
+    return int(time.monotonic() - BOOT_MONO)
+
+join_times: dict[tuple[int, int], int] = {}  # (guild_id, user_id) -> mono_seconds() at start
+pending_seconds: dict[tuple[int, int], int] = {}  # (guild_id, user_id) -> unsaved seconds
+# (guild_id, user_id) -> new open_sessions.started_at, or None to delete the row.
+# Flushed in the same transaction as pending_seconds so a credit and the
+# session bookkeeping that accounts for it always commit (or retry) together.
+pending_sessions: dict[tuple[int, int], datetime | None] = {}
+pending_lock = asyncio.Lock()
+flush_lock = asyncio.Lock()  # serialises flush_pending runs and /resetstats
+sessions_restored = False
+
+# Kept as one constant so every call sends identical text: asyncpg prepares
+# it once per connection and reuses the cached statement afterwards.
+# Takes three parallel arrays, so a whole batch is one statement; keys in a
+# batch must be unique (ON CONFLICT can't touch the same row twice).
+UPSERT_SQL = """
+    INSERT INTO voice_time (guild_id, user_id, total_seconds)
+    SELECT * FROM UNNEST($1::bigint[], $2::bigint[], $3::int[])
+    ON CONFLICT (guild_id, user_id)
+    DO UPDATE SET total_seconds = voice_time.total_seconds + EXCLUDED.total_seconds,
+                  last_updated = NOW()
+"""
+
+# open_sessions.started_at marks where the not-yet-saved part of a live
+# stream begins, so a restart can pick the session back up. Opens and
+# checkpoints share this upsert, so a checkpoint also recreates a lost row.
+OPEN_SESSION_SQL = """
+    INSERT INTO open_sessions (guild_id, user_id, started_at)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (guild_id, user_id) DO UPDATE SET started_at = EXCLUDED.started_at
+"""
+CLOSE_SESSION_SQL = "DELETE FROM open_sessions WHERE guild_id=$1 AND user_id=$2"
+LOAD_SESSIONS_SQL = "SELECT guild_id, user_id, started_at FROM open_sessions"
+
+DELETE_USER_SQL = "DELETE FROM voice_time WHERE guild_id=$1 AND user_id=$2"
+
+STATS_SQL = "SELECT total_seconds, last_updated FROM voice_time WHERE guild_id=$1 AND user_id=$2"
+
+# Shared by /leaderboard, /chart and the VC role updater.
+TOP_SQL = """
+    SELECT user_id, total_seconds
+    FROM voice_time
+    WHERE guild_id=$1
+    ORDER BY total_seconds DESC
+    LIMIT $2
+"""
+
+# Fixed once the table exists; changing it needs a manual re-partition.
+VOICE_TIME_PARTITIONS = 16
+
+# Batches at least this large go through COPY instead of executemany.
+COPY_MERGE_THRESHOLD = 1000
 
 async def init_db():
     global db_pool
-    db_pool = await asyncpg.create_pool(
+    pool = await asyncpg.create_pool(
         DATABASE_URL,
-        min_size=1,
-        max_size=10,
+        # Two warm connections cover the 30s flush overlapping a slash command;
+        # burst extras are closed after 10 idle minutes instead of lingering.
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        max_inactive_connection_lifetime=600,
         command_timeout=60,
         ssl="require",
+        # Commits return without waiting for the WAL flush. A crash can lose the
+        # last fraction of a second of writes, never consistency.
+        server_settings={"synchronous_commit": "off"},
+    )
+    # Published only once the schema is in place: callers treat a set db_pool
+    # as "ready", so a half-initialised pool must never become visible.
+    try:
+        async with pool.acquire() as conn:
+            await ensure_partitioned_voice_time(conn)
+            # Covering index: top-N queries read user_id straight from the index
+            # (index-only scan) instead of visiting the heap for every row.
+            # Created on the parent, so every partition gets its own copy.
+            await conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_guild_total_cover
+                ON voice_time(guild_id, total_seconds DESC) INCLUDE (user_id)
+                """
+            )
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS open_sessions (
+                    guild_id BIGINT,
+                    user_id BIGINT,
+                    started_at TIMESTAMPTZ NOT NULL,
+                    PRIMARY KEY (guild_id, user_id)
+                )
+                """
+            )
+    except BaseException:
+        pool.terminate()
+        raise
+    db_pool = pool
+    logger.info("✅ Database initialized")
+
+async def ensure_partitioned_voice_time(conn):
+    """Create voice_time hash-partitioned by guild, migrating a plain table if present."""
+    relkind = await conn.fetchval(
+        "SELECT relkind::text FROM pg_class WHERE oid = to_regclass('voice_time')"
     )
-    async with db_pool.acquire() as conn:
+    if relkind == "p":
+        return
+
+    async with conn.transaction():
+        # Another instance may be booting at the same time (zero-downtime
+        # deploys); only one gets to migrate, the other sees the result.
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('voice_time_partition'))")
+        if relkind is not None:
+            # Blocks the old instance's upserts until the swap commits, so none
+            # land between the copy and the DROP.
+            await conn.execute("LOCK TABLE voice_time IN ACCESS EXCLUSIVE MODE")
+        relkind = await conn.fetchval(
+            "SELECT relkind::text FROM pg_class WHERE oid = to_regclass('voice_time')"
+        )
+        if relkind == "p":
+            return
+
         await conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS voice_time (
+            CREATE TABLE voice_time_new (
                 guild_id BIGINT,
                 user_id BIGINT,
                 total_seconds INTEGER DEFAULT 0,
                 last_updated TIMESTAMP DEFAULT NOW(),
                 PRIMARY KEY (guild_id, user_id)
-            )
+            ) PARTITION BY HASH (guild_id)
             """
         )
-        await conn.execute(
-            """
-            CREATE INDEX IF NOT EXISTS idx_guild_total
-            ON voice_time(guild_id, total_seconds DESC)
-            """
-        )
-    logger.info("✅ Database initialized")
+        for i in range(VOICE_TIME_PARTITIONS):
+            await conn.execute(
+                f"""
+                CREATE TABLE voice_time_p{i} PARTITION OF voice_time_new
+                FOR VALUES WITH (MODULUS {VOICE_TIME_PARTITIONS}, REMAINDER {i})
+                """
+            )
+        if relkind is not None:
+            await conn.execute(
+                """
+                INSERT INTO voice_time_new (guild_id, user_id, total_seconds, last_updated)
+                SELECT guild_id, user_id, total_seconds, last_updated FROM voice_time
+                """
+            )
+            await conn.execute("DROP TABLE voice_time")
+        await conn.execute("ALTER TABLE voice_time_new RENAME TO voice_time")
+    logger.info("🧱 voice_time partitioned into %d hash partitions", VOICE_TIME_PARTITIONS)
+
+async def restore_open_sessions():
+    """Resume sessions that were live when the bot last stopped."""
+    rows = await db_pool.fetch(LOAD_SESSIONS_SQL)
+
+    now = mono_seconds()
+    wall_now = datetime.now(timezone.utc)
+    resumed, deferred, stale = 0, 0, 0
+    async with pending_lock:
+        for row in rows:
+            key = (row["guild_id"], row["user_id"])
+            if key in join_times:
+                continue
+
+            guild = bot.get_guild(key[0])
+            available = guild is not None and not guild.unavailable
+            member = guild.get_member(key[1]) if available else None
+            if member is None and not (available and guild.chunked):
+                # An incomplete cache proves nothing about the member; track from
+                # now and let the save loop decide once the guild resolves.
+                join_times[key] = now
+                pending_sessions[key] = wall_now
+                deferred += 1
+                continue
+
+            if member and member.voice and member.voice.self_stream:
+                # Whether they streamed through the whole downtime is unknown;
+                # credit at most one checkpoint interval of the gap (what a crash
+                # could have lost) and resume from now.
+                gap = int((wall_now - row["started_at"]).total_seconds())
+                gap = min(gap, CHECKPOINT_SECONDS)
+                if gap >= 5:
+                    pending_seconds[key] = pending_seconds.get(key, 0) + gap
+                join_times[key] = now
+                pending_sessions[key] = wall_now
+                resumed += 1
+                continue
+
+            # The stream ended while we were down, at a time we never saw; only
+            # what the last checkpoint saved counts.
+            pending_sessions[key] = None
+            stale += 1
+
+    await flush_pending()
+    logger.info(
+        "♻️ Restored %d open sessions (%d pending guild cache), closed %d stale",
+        resumed, deferred, stale,
+    )
+
+async def add_pending(key: tuple[int, int], secs: int, close: bool = False):
+    """Buffer secs for key; with close, also queue its open_sessions row for deletion."""
+    async with pending_lock:
+        if close:
+            pending_sessions[key] = None
+        total = 0
+        if secs:
+            total = pending_seconds[key] = pending_seconds.get(key, 0) + secs
+        # Flush early when the buffer is large or one user has a lot riding on it.
+        full = len(pending_seconds) >= PENDING_FLUSH_SIZE or total >= PENDING_MAX_SECONDS
+    if full:
+        await flush_pending()
+
+async def copy_merge_seconds(conn, rows):
+    """COPY (guild_id, user_id, seconds) rows into staging and merge them in one upsert.
+
+    Must run inside a transaction; the staging table is dropped on commit.
+    """
+    await conn.execute(
+        """
+        CREATE TEMP TABLE voice_time_staging (
+            guild_id BIGINT,
+            user_id BIGINT,
+            total_seconds INTEGER
+        ) ON COMMIT DROP
+        """
+    )
+    await conn.copy_records_to_table(
+        "voice_time_staging",
+        records=rows,
+        columns=("guild_id", "user_id", "total_seconds"),
+    )
+    await conn.execute(
+        """
+        INSERT INTO voice_time (guild_id, user_id, total_seconds)
+        SELECT guild_id, user_id, SUM(total_seconds)
+        FROM voice_time_staging
+        GROUP BY guild_id, user_id
+        ON CONFLICT (guild_id, user_id)
+        DO UPDATE SET total_seconds = voice_time.total_seconds + EXCLUDED.total_seconds,
+                      last_updated = NOW()
+        """
+    )
+
+async def add_seconds(conn, rows):
+    if len(rows) >= COPY_MERGE_THRESHOLD:
+        await copy_merge_seconds(conn, rows)
+    else:
+        guild_ids, user_ids, secs = zip(*rows)
+        await conn.execute(UPSERT_SQL, guild_ids, user_ids, secs)
+
+async def flush_pending():
+    """Write buffered deltas and open-session bookkeeping in one transaction."""
+    if db_pool is None:
+        return
+
+    # Held from snapshot to commit/re-queue so /resetstats can't slip in between.
+    async with flush_lock:
+        async with pending_lock:
+            batch = dict(pending_seconds)
+            sessions = dict(pending_sessions)
+            pending_seconds.clear()
+            pending_sessions.clear()
+        if not (batch or sessions):
+            return
+
+        rows = [(guild_id, user_id, secs) for (guild_id, user_id), secs in batch.items()]
+        opened = [(*key, started_at) for key, started_at in sessions.items() if started_at is not None]
+        closed = [key for key, started_at in sessions.items() if started_at is None]
+        try:
+            async with db_pool.acquire() as conn, conn.transaction():
+                if rows:
+                    await add_seconds(conn, rows)
+                if opened:
+                    await conn.executemany(OPEN_SESSION_SQL, opened)
+                if closed:
+                    await conn.executemany(CLOSE_SESSION_SQL, closed)
+        except Exception as e:
+            # Put everything back so the next flush retries it; session changes
+            # queued since the snapshot are newer and win.
+            async with pending_lock:
+                for key, secs in batch.items():
+                    pending_seconds[key] = pending_seconds.get(key, 0) + secs
+                for key, started_at in sessions.items():
+                    pending_sessions.setdefault(key, started_at)
+            logger.error("Flush of %d deltas failed, will retry: %s", len(rows), e)
+            return
+
+        if rows:
+            logger.info("💾 Flushed %d voice-time deltas", len(rows))
+
+async def flush_on_shutdown():
+    """Credit live sessions up to now and write everything still buffered."""
+    if db_pool is None:
+        return
+
+    now = mono_seconds()
+    wall_now = datetime.now(timezone.utc)
+    async with pending_lock:
+        for key, start in join_times.items():
+            if now > start:
+                pending_seconds[key] = pending_seconds.get(key, 0) + now - start
+            join_times[key] = now
+            pending_sessions[key] = wall_now
+    await flush_pending()
+    await db_pool.close()
+    logger.info("🛑 Shutdown flush done (%d live sessions checkpointed)", len(join_times))
 
 # ---------------- Events ----------------
 @bot.event
 async def on_ready():
-    logger.info(f"Logged in as {bot.user} (ID: {bot.user.id})")
+    global sessions_restored
+    logger.info("Logged in as %s (ID: %s)", bot.user, bot.user.id)
+    # A fresh session rebuilt the member cache; names cached before it may be stale.
+    _display_names.clear()
 
+    # main() normally opens the pool during login; this covers any other start path.
     if db_pool is None:
         await init_db()
+    # Needs the guild/member cache, so it can't run before the gateway is up.
+    if not sessions_restored:
+        sessions_restored = True
+        await restore_open_sessions()
 
     # Do NOT auto-sync commands here.
     if not save_streaming_time.is_running():
@@ -136,6 +431,12 @@ async def on_ready():
 async def on_voice_state_update(member, before, after):
     if member.bot or not member.guild:
         return
+    # Mute/deafen/move events with no stream on either side can't change tracking,
+    # and neither can mute/deafen/video toggles mid-stream in the same channel.
+    if not (before.self_stream or after.self_stream):
+        return
+    if before.self_stream == after.self_stream and before.channel == after.channel:
+        return
 
     key = (member.guild.id, member.id)
 
@@ -143,83 +444,105 @@ async def on_voice_state_update(member, before, after):
     was_streaming_before = before.channel is not None and before.self_stream
 
     if is_streaming_now and not was_streaming_before and key not in join_times:
-        join_times[key] = asyncio.get_running_loop().time()
-        ch = after.channel.name if after.channel else "Unknown"
-        logger.info(f"▶️ Start track: {member} in {ch}")
+        join_times[key] = mono_seconds()
+        async with pending_lock:
+            pending_sessions[key] = datetime.now(timezone.utc)
+        # Channel str() is its name; only formatted if INFO is enabled.
+        logger.info("▶️ Start track: %s in %s", member, after.channel)
 
     elif was_streaming_before and not is_streaming_now and key in join_times:
         start = join_times.pop(key)
-        secs = int(asyncio.get_running_loop().time() - start)
-        if secs < 5:
-            return
+        secs = mono_seconds() - start
+        # The credit and the session close go out in the same flush.
+        await add_pending(key, secs if secs >= 5 else 0, close=True)
+        if secs >= 5:
+            logger.info("⏹️ Stop track: %s (%ss queued)", member, secs)
 
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO voice_time (guild_id, user_id, total_seconds)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (guild_id, user_id)
-                DO UPDATE SET total_seconds = voice_time.total_seconds + $3,
-                              last_updated = NOW()
-                """,
-                member.guild.id,
-                member.id,
-                secs,
-            )
-        logger.info(f"💾 Saved {secs}s for {member}")
+@bot.event
+async def on_guild_remove(guild):
+    # No voice updates will arrive for this guild again; end its sessions now.
+    now = mono_seconds()
+    for key in [k for k in join_times if k[0] == guild.id]:
+        secs = now - join_times.pop(key)
+        await add_pending(key, secs if secs >= 5 else 0, close=True)
+
+# ---------------- Display-name cache ----------------
+_display_names: dict[tuple[int, int], str] = {}  # (guild_id, user_id) -> display name
+DISPLAY_NAME_CACHE_SIZE = 2048
+
+def _display_name(guild_id: int, user_id: int) -> str:
+    name = _display_names.get((guild_id, user_id))
+    if name is None:
+        guild = bot.get_guild(guild_id)
+        member = guild.get_member(user_id) if guild else None
+        # Misses aren't cached: the member cache may still be filling after a
+        # reconnect, and a stored placeholder would outlive it.
+        if not member:
+            return f"User {user_id}"
+        if len(_display_names) >= DISPLAY_NAME_CACHE_SIZE:
+            _display_names.clear()
+        name = _display_names[(guild_id, user_id)] = member.display_name
+    return name
+
+@bot.event
+async def on_member_update(before, after):
+    if before.display_name != after.display_name:
+        _display_names.clear()
+
+@bot.event
+async def on_user_update(before, after):
+    if before.display_name != after.display_name:
+        _display_names.clear()
+
+@bot.event
+async def on_member_remove(member):
+    _display_names.clear()
 
 # ---------------- Tasks ----------------
 @tasks.loop(seconds=30)
 async def save_streaming_time():
     if db_pool is None:
         return
+    # Idle tick: nobody streaming and nothing buffered.
+    if not (join_times or pending_seconds or pending_sessions):
+        return
 
-    now = asyncio.get_running_loop().time()
-    for (guild_id, user_id) in list(join_times.keys()):
-        start = join_times.get((guild_id, user_id))
-        if start is None:
-            continue
-
-        guild = bot.get_guild(guild_id)
-        if not guild:
+    now = mono_seconds()
+    wall_now = datetime.now(timezone.utc)
+    sessions, credits = {}, []
+    # No awaits inside this loop, so the snapshot can't go stale under us.
+    for key, start in list(join_times.items()):
+        # After a reconnect the guild cache refills over several seconds;
+        # until the guild is back, nothing about the member is known.
+        # Removed guilds are handled in on_guild_remove.
+        guild = bot.get_guild(key[0])
+        if not guild or guild.unavailable:
             continue
-        member = guild.get_member(user_id)
-        if not member:
+        member = guild.get_member(key[1])
+        # Only a complete member cache makes a miss mean "left the guild";
+        # until then keep the session (and keep checkpointing resolved ones).
+        if member is None and not guild.chunked:
             continue
-
-        is_streaming = bool(member.voice and member.voice.self_stream)
+        is_streaming = bool(member and member.voice and member.voice.self_stream)
 
         if not is_streaming:
-            secs = int(now - start)
-            join_times.pop((guild_id, user_id), None)
-            if secs >= 5:
-                async with db_pool.acquire() as conn:
-                    await conn.execute(
-                        """
-                        INSERT INTO voice_time (guild_id, user_id, total_seconds)
-                        VALUES ($1, $2, $3)
-                        ON CONFLICT (guild_id, user_id)
-                        DO UPDATE SET total_seconds = voice_time.total_seconds + $3,
-                                      last_updated = NOW()
-                        """,
-                        guild_id, user_id, secs
-                    )
+            del join_times[key]
+            sessions[key] = None
+            if now - start >= 5:
+                credits.append((key, now - start))
             continue
 
-        elapsed = int(now - start)
-        if elapsed >= 30:
-            async with db_pool.acquire() as conn:
-                await conn.execute(
-                    """
-                    INSERT INTO voice_time (guild_id, user_id, total_seconds)
-                    VALUES ($1, $2, $3)
-                    ON CONFLICT (guild_id, user_id)
-                    DO UPDATE SET total_seconds = voice_time.total_seconds + $3,
-                                  last_updated = NOW()
-                    """,
-                    guild_id, user_id, elapsed
-                )
-            join_times[(guild_id, user_id)] = asyncio.get_running_loop().time()
+        elapsed = now - start
+        if elapsed >= CHECKPOINT_SECONDS:
+            credits.append((key, elapsed))
+            join_times[key] = now
+            sessions[key] = wall_now
+
+    async with pending_lock:
+        for key, secs in credits:
+            pending_seconds[key] = pending_seconds.get(key, 0) + secs
+        pending_sessions.update(sessions)
+    await flush_pending()
 
 @save_streaming_time.before_loop
 async def before_save_loop():
@@ -228,34 +551,31 @@ async def before_save_loop():
 @tasks.loop(minutes=15)
 async def auto_update_vc_roles():
     await bot.wait_until_ready()
-    for guild in bot.guilds:
-        await update_guild_vc_roles(guild)
-        if len(bot.guilds) > 1:
-            await asyncio.sleep(5)
+    sem = asyncio.Semaphore(GUILD_UPDATE_CONCURRENCY)
+
+    async def bounded(guild: discord.Guild):
+        async with sem:
+            try:
+                await update_guild_vc_roles(guild)
+            except Exception as e:
+                logger.error("VC role update failed for %s: %s", guild.name, e)
+
+    await asyncio.gather(*(bounded(guild) for guild in bot.guilds))
 
 @auto_update_vc_roles.before_loop
 async def before_role_loop():
     await bot.wait_until_ready()
+    # Spread the first run so restarts (or several instances) don't all hit Discord at once.
+    await asyncio.sleep(random.uniform(0, 60))
 
 async def update_guild_vc_roles(guild: discord.Guild):
     if db_pool is None:
         return
 
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT user_id, total_seconds
-            FROM voice_time
-            WHERE guild_id=$1
-            ORDER BY total_seconds DESC
-            LIMIT $2
-            """,
-            guild.id,
-            MAX_RANKED_USERS,
-        )
+    rows = await fetch_top(guild.id, MAX_RANKED_USERS)
 
     if not rows:
-        logger.info(f"⚠️ No data for {guild.name}")
+        logger.info("⚠️ No data for %s", guild.name)
         return
 
     role_cache = {}
@@ -268,40 +588,71 @@ async def update_guild_vc_roles(guild: discord.Guild):
             missing.append(rid)
 
     if missing:
-        logger.warning(f"{guild.name} missing role IDs: {missing}")
+        logger.warning("%s missing role IDs: %s", guild.name, missing)
         return
 
-    updated = 0
+    # Reversed, the hierarchy's thresholds ascend (1, 2, 3, ... None), so one
+    # pointer walk fills the rank -> role table for every fetched rank.
+    rank_to_role = [None] * (len(rows) + 1)
+    tiers = iter(reversed(ROLE_HIERARCHY))
+    rid, threshold = next(tiers)
+    for rank in range(1, len(rows) + 1):
+        while threshold is not None and rank > threshold:
+            rid, threshold = next(tiers)
+        rank_to_role[rank] = role_cache[rid]
+
+    plan = []
     for rank, row in enumerate(rows, start=1):
         member = guild.get_member(row["user_id"])
         if not member:
             continue
 
-        target = None
-        for rid, threshold in reversed(ROLE_HIERARCHY):
-            if threshold is None or rank <= threshold:
-                target = role_cache[rid]
-                break
-
-        current = [r for r in member.roles if r.id in VC_ROLE_IDS]
-        if len(current) == 1 and target and current[0].id == target.id:
+        target = rank_to_role[rank]
+        # Member.roles rebuilds and sorts a list on every access; read it once.
+        role_ids = {r.id for r in member.roles[1:]}
+        if role_ids & VC_ROLE_IDS == ({target.id} if target else set()):
             continue
 
-        try:
-            if current:
-                await member.remove_roles(*current, reason="VC rank update")
-                await asyncio.sleep(ROLE_EDIT_DELAY)
-            if target:
-                await member.add_roles(target, reason=f"Rank #{rank}")
-                updated += 1
-                await asyncio.sleep(ROLE_EDIT_DELAY)
-        except discord.Forbidden:
-            logger.warning(f"No permission to update roles for {member} in {guild.name}")
-        except discord.HTTPException as e:
-            logger.error(f"HTTP error updating {member}: {e}")
-            await asyncio.sleep(max(ROLE_EDIT_DELAY * 3, 3))
-
-    logger.info(f"🔄 {guild.name}: updated {updated} members")
+        plan.append((rank, member, target))
+
+    queue = asyncio.Queue()
+    for item in plan:
+        queue.put_nowait(item)
+
+    updated = 0
+
+    async def worker():
+        nonlocal updated
+        while True:
+            try:
+                rank, member, target = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            async with role_edit_sem:
+                if await apply_vc_role(guild, member, target, rank):
+                    updated += 1
+
+    workers = min(ROLE_UPDATE_WORKERS, len(plan))
+    await asyncio.gather(*(worker() for _ in range(workers)))
+
+    logger.info("🔄 %s: updated %d members", guild.name, updated)
+
+async def apply_vc_role(guild: discord.Guild, member: discord.Member, target, rank: int) -> bool:
+    # discord.py queues requests per rate-limit bucket, so no manual pacing here.
+    try:
+        # One PATCH replaces the whole role set: non-VC roles plus the target.
+        # Read the roles now, not at planning time: the edit may run much later,
+        # and a stale list would undo roles others changed in the meantime.
+        kept = [r for r in member.roles[1:] if r.id not in VC_ROLE_IDS]
+        new_roles = kept + [target] if target else kept
+        await member.edit(roles=new_roles, reason=f"VC rank #{rank}")
+        return True
+    except discord.Forbidden:
+        logger.warning("No permission to update roles for %s in %s", member, guild.name)
+    except discord.HTTPException as e:
+        logger.error("HTTP error updating %s: %s", member, e)
+        await asyncio.sleep(getattr(e, "retry_after", None) or max(ROLE_EDIT_DELAY * 3, 3))
+    return False
 
 # ---------------- Prefix sync command ----------------
 @bot.command()
@@ -309,9 +660,9 @@ async def update_guild_vc_roles(guild: discord.Guild):
 @commands.has_permissions(administrator=True)
 async def sync(ctx: commands.Context, spec: str | None = None):
     """
-    !sync      -> global sync
-    !sync ~    -> sync to current guild only (fast)
-    !sync *    -> copy global to current guild and sync (fast; testing)
+    @Bot sync      -> global sync
+    @Bot sync ~    -> sync to current guild only (fast)
+    @Bot sync *    -> copy global to current guild and sync (fast; testing)
     """
     try:
         if spec == "~":
@@ -332,24 +683,79 @@ async def sync_error(ctx, error):
     if isinstance(error, commands.MissingPermissions):
         await ctx.send("❌ Administrator only.")
 
+# ---------------- Charts ----------------
+CHART_WIDTH = 1200
+CHART_ROW_HEIGHT = 40
+CHART_TOP = 80
+CHART_BAR_LEFT = 240
+CHART_BAR_MAX = 860
+CHART_BG = "#1e1e2e"
+CHART_BAR = "#5865F2"
+CHART_TEXT = "#ffffff"
+
+@functools.lru_cache(maxsize=None)
+def _chart_font(size: int):
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", size)
+    except OSError:
+        return ImageFont.load_default()
+
+def _bar_widths(hrs: list[float]) -> list[int]:
+    """Pixel width of every bar, scaled so the longest fills CHART_BAR_MAX."""
+    scale = CHART_BAR_MAX / (max(hrs) or 1.0)
+    return [int(h * scale) for h in hrs]
+
+def _render_chart(names: list[str], hrs: list[float], title: str) -> bytes:
+    # Imported on first use so bots that never run /chart never load Pillow.
+    from PIL import Image, ImageDraw
+
+    height = CHART_TOP + len(names) * CHART_ROW_HEIGHT + 20
+    img = Image.new("RGB", (CHART_WIDTH, height), CHART_BG)
+    draw = ImageDraw.Draw(img)
+    font = _chart_font(16)
+
+    draw.text((20, 25), title, fill=CHART_TEXT, font=_chart_font(24))
+    for i, (name, h, w) in enumerate(zip(names, hrs, _bar_widths(hrs))):
+        y = CHART_TOP + i * CHART_ROW_HEIGHT
+        draw.text((20, y + 10), name, fill=CHART_TEXT, font=font)
+        draw.rectangle((CHART_BAR_LEFT, y + 6, CHART_BAR_LEFT + max(w, 1), y + CHART_ROW_HEIGHT - 6), fill=CHART_BAR)
+        draw.text((CHART_BAR_LEFT + w + 10, y + 10), f"{h:.2f}h", fill=CHART_TEXT, font=font)
+
+    buf = io.BytesIO()
+    # zlib level 1 trades ~30% more bytes (still tens of KB) for a faster encode.
+    img.save(buf, "PNG", optimize=False, compress_level=1)
+    return buf.getvalue()
+
 # ---------------- Slash commands ----------------
+TOP_CACHE_TTL = 20  # seconds; totals only move on flushes anyway
+_top_cache: dict[tuple[int, int], tuple[float, list]] = {}  # (guild_id, limit) -> (fetched_at, rows)
+
+async def fetch_top(guild_id: int, limit: int):
+    key = (guild_id, limit)
+    hit = _top_cache.get(key)
+    if hit and time.monotonic() - hit[0] < TOP_CACHE_TTL:
+        return hit[1]
+    rows = await db_pool.fetch(TOP_SQL, guild_id, limit)
+    _top_cache[key] = (time.monotonic(), rows)
+    return rows
+
+def invalidate_top_cache(guild_id: int):
+    for key in [k for k in _top_cache if k[0] == guild_id]:
+        del _top_cache[key]
+
+async def fetch_stats(guild_id: int, user_id: int):
+    return await db_pool.fetchrow(STATS_SQL, guild_id, user_id)
+
 @bot.tree.command(name="leaderboard", description="Show streaming time leaderboard (limit: 1-20)")
 async def leaderboard_slash(interaction: discord.Interaction, limit: int = 10):
     limit = max(1, min(limit, 20))
-    await interaction.response.defer()
-
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT user_id, total_seconds
-            FROM voice_time
-            WHERE guild_id=$1
-            ORDER BY total_seconds DESC
-            LIMIT $2
-            """,
-            interaction.guild.id,
-            limit,
-        )
+    # Acknowledge the interaction while the query is in flight.
+    _, rows = await asyncio.gather(
+        interaction.response.defer(),
+        fetch_top(interaction.guild.id, limit),
+    )
 
     if not rows:
         return await interaction.followup.send("No streaming stats yet.")
@@ -357,8 +763,7 @@ async def leaderboard_slash(interaction: discord.Interaction, limit: int = 10):
     embed = discord.Embed(title=f"🎤 Top {len(rows)} Streamers", color=0x5865F2)
     lines = []
     for i, row in enumerate(rows, start=1):
-        m = interaction.guild.get_member(row["user_id"])
-        name = m.display_name if m else f"User {row['user_id']}"
+        name = _display_name(interaction.guild.id, row["user_id"])
         hours = row["total_seconds"] / 3600
         medal = ["🥇", "🥈", "🥉"][i - 1] if i <= 3 else f"**{i}.**"
         lines.append(f"{medal} {name} — **{hours:.2f}** hours")
@@ -367,15 +772,11 @@ async def leaderboard_slash(interaction: discord.Interaction, limit: int = 10):
 
 @bot.tree.command(name="stats", description="View streaming stats for you or a user")
 async def stats_slash(interaction: discord.Interaction, user: discord.Member | None = None):
-    await interaction.response.defer()
     target = user or interaction.user
-
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT total_seconds, last_updated FROM voice_time WHERE guild_id=$1 AND user_id=$2",
-            interaction.guild.id,
-            target.id,
-        )
+    _, row = await asyncio.gather(
+        interaction.response.defer(),
+        fetch_stats(interaction.guild.id, target.id),
+    )
 
     if not row:
         return await interaction.followup.send(f"{target.display_name} has no streaming data yet.")
@@ -389,47 +790,23 @@ async def stats_slash(interaction: discord.Interaction, user: discord.Member | N
 @bot.tree.command(name="chart", description="Streaming time bar chart (limit: 1-15)")
 async def chart_slash(interaction: discord.Interaction, limit: int = 10):
     limit = max(1, min(limit, 15))
-    await interaction.response.defer()
-
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT user_id, total_seconds
-            FROM voice_time
-            WHERE guild_id=$1
-            ORDER BY total_seconds DESC
-            LIMIT $2
-            """,
-            interaction.guild.id,
-            limit,
-        )
+    # Acknowledge the interaction while the query is in flight.
+    _, rows = await asyncio.gather(
+        interaction.response.defer(),
+        fetch_top(interaction.guild.id, limit),
+    )
 
     if not rows:
         return await interaction.followup.send("No data for chart.")
 
-    names, hrs = [], []
-    for r in rows:
-        m = interaction.guild.get_member(r["user_id"])
-        names.append((m.name if m else f"User{r['user_id']}")[:20])
-        hrs.append(r["total_seconds"] / 3600)
-
-    hrs = np.array(hrs)
-    plt.style.use("dark_background")
-    fig, ax = plt.subplots(figsize=(12, max(6, len(names) * 0.5)))
-    y = np.arange(len(names))
-    ax.barh(y, hrs, color="#5865F2")
-    ax.set_yticks(y)
-    ax.set_yticklabels(names)
-    ax.set_xlabel("Hours streaming")
-    ax.set_title(f"{interaction.guild.name} top {len(names)}")
-    plt.tight_layout()
+    guild_id = interaction.guild.id
+    names = [_display_name(guild_id, r["user_id"])[:20] for r in rows]
+    hrs = [r["total_seconds"] / 3600 for r in rows]
 
-    buf = io.BytesIO()
-    plt.savefig(buf, format="PNG", dpi=130, bbox_inches="tight")
-    buf.seek(0)
-    plt.close(fig)
+    title = f"{interaction.guild.name} top {len(names)}"
+    png = await asyncio.to_thread(_render_chart, names, hrs, title)
 
-    await interaction.followup.send(file=discord.File(buf, filename="stream_chart.png"))
+    await interaction.followup.send(file=discord.File(io.BytesIO(png), filename="stream_chart.png"))
 
 @bot.tree.command(name="updateroles", description="Manually update VC rank roles (Admin only)")
 @discord.app_commands.checks.has_permissions(administrator=True)
@@ -447,12 +824,27 @@ async def updateroles_error(interaction: discord.Interaction, error):
 @discord.app_commands.checks.has_permissions(administrator=True)
 async def resetstats_slash(interaction: discord.Interaction, user: discord.Member):
     await interaction.response.defer(ephemeral=True)
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            "DELETE FROM voice_time WHERE guild_id=$1 AND user_id=$2",
-            interaction.guild.id,
-            user.id,
-        )
+    key = (interaction.guild.id, user.id)
+
+    # Buffered or in-progress time would otherwise land on the freshly reset row.
+    # flush_lock waits out any flush that already snapshotted this user's delta
+    # (it either commits before the DELETE or re-queues before the pop), and
+    # keeps new flushes out until the reset is committed.
+    async with flush_lock:
+        async with pending_lock:
+            pending_seconds.pop(key, None)
+            pending_sessions.pop(key, None)
+        live = key in join_times
+        if live:
+            join_times[key] = mono_seconds()
+
+        async with db_pool.acquire() as conn, conn.transaction():
+            await conn.execute(DELETE_USER_SQL, *key)
+            if live:
+                await conn.execute(OPEN_SESSION_SQL, *key, datetime.now(timezone.utc))
+            else:
+                await conn.execute(CLOSE_SESSION_SQL, *key)
+    invalidate_top_cache(key[0])
     await interaction.followup.send(f"✅ Reset stats for {user.display_name}.", ephemeral=True)
 
 @resetstats_slash.error
@@ -465,28 +857,67 @@ def looks_like_cloudflare_1015(exc: Exception) -> bool:
     s = str(exc).lower()
     return ("error 1015" in s) or ("cloudflare" in s) or ("access denied" in s) or ("<!doctype html>" in s)
 
-if __name__ == "__main__":
-    keep_alive()
-    time.sleep(random.uniform(2, 6))
+async def main():
+    # Render stops services with SIGTERM; turn it into a cancel so the
+    # shutdown flush below still runs.
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass
 
-    while True:
-        try:
-            bot.run(TOKEN, log_handler=None)
-            break
-        except discord.errors.HTTPException as e:
-            # If Discord/Cloudflare blocks this IP, don't crash-loop and extend it. [web:67]
-            if looks_like_cloudflare_1015(e):
-                logger.error("Cloudflare 1015 / HTML 429 during login. Sleeping 45 minutes then retrying.")
-                time.sleep(45 * 60)
-                continue
+    # Started before login so uptime pings are answered during back-off sleeps too.
+    runner = await start_web_server()
+    await asyncio.sleep(random.uniform(2, 6))
 
-            if getattr(e, "status", None) == 429:
-                logger.error("Discord API 429. Sleeping 10 minutes then retrying.")
-                time.sleep(10 * 60)
-                continue
+    try:
+        while True:
+            try:
+                async with bot:
+                    # bot.start() is login + connect; opening the DB pool
+                    # alongside the login round trip overlaps the two.
+                    if db_pool is None:
+                        db_task = asyncio.create_task(init_db())
+                        try:
+                            await bot.login(TOKEN)
+                        except BaseException:
+                            # Don't leave the pool setup running (or its error
+                            # unretrieved) behind a failed login.
+                            db_task.cancel()
+                            (db_err,) = await asyncio.gather(db_task, return_exceptions=True)
+                            if isinstance(db_err, Exception):
+                                logger.error("DB init failed alongside login: %s", db_err)
+                            raise
+                        await db_task
+                    else:
+                        await bot.login(TOKEN)
+                    await bot.connect()
+                break
+            except discord.errors.HTTPException as e:
+                # If Discord/Cloudflare blocks this IP, don't crash-loop and extend it. [web:67]
+                if looks_like_cloudflare_1015(e):
+                    logger.error("Cloudflare 1015 / HTML 429 during login. Sleeping 45 minutes then retrying.")
+                    delay = 45 * 60
+                elif getattr(e, "status", None) == 429:
+                    logger.error("Discord API 429. Sleeping 10 minutes then retrying.")
+                    delay = 10 * 60
+                else:
+                    logger.error("HTTPException: %s. Sleeping 5 minutes then retrying.", e)
+                    delay = 5 * 60
+            except Exception as e:
+                logger.error("Fatal: %s. Sleeping 5 minutes then retrying.", e)
+                delay = 5 * 60
+
+            # Leaving `async with bot` closed the client; reopen it before retrying.
+            bot.clear()
+            _display_names.clear()
+            await asyncio.sleep(delay)
+    except asyncio.CancelledError:
+        # The SIGTERM path above: a normal stop, so exit cleanly once flushed
+        # instead of letting asyncio.run re-raise it as a traceback.
+        logger.info("🛑 Shutdown requested")
+    finally:
+        await flush_on_shutdown()
+        await runner.cleanup()
 
-            logger.error(f"HTTPException: {e}. Sleeping 5 minutes then retrying.")
-            time.sleep(5 * 60)
-        except Exception as e:
-            logger.error(f"Fatal: {e}. Sleeping 5 minutes then retrying.")
-            time.sleep(5 * 60)
+if __name__ == "__main__":
+    asyncio.run(main())